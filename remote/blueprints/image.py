@@ -1,21 +1,75 @@
 import base64
 import io
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Iterable, List, Tuple
+from functools import partial
+from typing import BinaryIO, Iterable, List, Tuple
 
+import magic
 import pillow_avif  # noqa: F401
 from flask import Blueprint, request
-from PIL import Image
-from resizeimage import resizeimage
+from flask.blueprints import BlueprintSetupState
+from PIL import Image, JpegImagePlugin
 from sentry_sdk import capture_exception
 
-from remote.utilities.image import AvatarSize, ExifTag, ImageHandle, ImageMIME
+from remote.utilities.image import (
+    ICON_MIMES,
+    AvatarSize,
+    ExifTag,
+    ImageHandle,
+    ImageMIME,
+)
 from remote.wrapper import APIDoc, APIError, Methods, api_doc, error, success
 
 # Please keep the blueprint definition at the top uniformly.
 image_bp = Blueprint("image", __name__)
 
+# Encoder options of each avatar output format, avatars are small enough that
+# the fastest zlib level and WebP method barely grow them.
+AVATAR_SAVE_OPTIONS = {
+    ImageMIME.PNG: {"compress_level": 1},
+    ImageMIME.WEBP: {"quality": 90, "method": 0},
+}
+
+# Metadata Pillow reads into `Image.info`, besides EXIF and PNG text chunks.
+METADATA_INFO_KEYS = frozenset({"xmp", "XML:com.adobe.xmp", "comment", "icc_profile"})
+
+# Pillow releases the GIL while resampling and encoding, so the avatar sizes
+# of one upload can be rendered on all cores without leaving the process.
+_avatar_pool = ThreadPoolExecutor(
+    max_workers=len(AvatarSize), thread_name_prefix="avatar"
+)
+
+
+def _renew_avatar_pool():
+    """Threads don't survive a fork, give the child process a pool of its own."""
+    global _avatar_pool
+    _avatar_pool = ThreadPoolExecutor(
+        max_workers=len(AvatarSize), thread_name_prefix="avatar"
+    )
+
+
+os.register_at_fork(after_in_child=_renew_avatar_pool)
+
+
+@image_bp.record_once
+def _warm_up(_state: BlueprintSetupState):
+    """Pay the first-call costs at startup, instead of on the first uploads."""
+    # Load the libmagic database and all the PIL format plugins.
+    magic.from_buffer(b"", mime=True)
+    Image.init()
+    # Run the avatar path once on a blank image. Inline, as the app may be created
+    # before gunicorn forks its workers, and threads started here would be lost.
+    blank = Image.new("RGB", (max(AvatarSize), max(AvatarSize)))
+    for resized in _cascade(blank, list(AvatarSize)):
+        _save_single_frame_data(
+            resized,
+            format=ImageMIME.PNG.pil_format,
+            **AVATAR_SAVE_OPTIONS[ImageMIME.PNG],
+        )
+
 
 @dataclass
 class ImageInfo:
@@ -31,7 +85,7 @@ class ImageInfo:
 @image_bp.route("/images/info", methods=Methods.common())
 @api_doc(APIDoc(usage="Upload an image file and show its info like size and type"))
 def images_info():
-    received = get_file_bytes()
+    received = get_file_stream()
     if isinstance(received, APIError):
         return error(received)
 
@@ -61,7 +115,7 @@ def images_info():
 )
 def prepare_jpeg():
     # Check uploaded file is valid or not.
-    received = get_file_bytes()
+    received = get_file_stream()
     if isinstance(received, APIError):
         return error(received)
 
@@ -78,11 +132,24 @@ def prepare_jpeg():
     #
     # 1. Remove GPS
     # 2. Auto Rotate
+    #
+    # Then re-encode it in the same pass, with the quantization tables and the
+    # subsampling of the upload, to keep its quality rather than `quality=75`.
+    jpeg_options = {
+        "qtables": handler.image.quantization,
+        "subsampling": JpegImagePlugin.get_sampling(handler.image),
+    }
     try:
         handler.auto_rotate().remove_exif(ExifTag.GPS_INFO)
+        output = handler.encode(ImageMIME.JPEG, **jpeg_options)
     except Exception as e:  # noqa
         capture_exception(e)
         return error(APIError(message=f"Failed to prepare image: {e}"), status=500)
+
+    # Hand back the image itself, skipping the base64 and JSON wrapping.
+    if _wants_raw_image(ImageMIME.JPEG):
+        return success(output, mimetype=ImageMIME.JPEG.mime)
+
     return success(
         {
             "uploaded": {
@@ -90,7 +157,7 @@ def prepare_jpeg():
                 "mime": handler.mime.mime,
             },
             "status": "ok",
-            "output": handler.b64_content,
+            "output": base64.b64encode(output).decode("utf-8"),
             "success": True,
         }
     )
@@ -102,7 +169,7 @@ def prepare_jpeg():
 )
 def fit(box: int):
     # Check uploaded file is valid or not.
-    received = get_file_bytes()
+    received = get_file_stream()
     if isinstance(received, APIError):
         return error(received)
 
@@ -115,10 +182,16 @@ def fit(box: int):
     image = handler.image
 
     start = time.time()
-    if handler.is_animated and request.args.get("animated"):
+    # The cost is measured on the monotonic clock, in whole milliseconds.
+    started = time.perf_counter_ns()
+    if _fits_as_is(handler, box):
+        # Nothing to shrink, hand back the upload without re-encoding it.
+        output_format = image.format
+        data = handler.raw_content
+    elif handler.is_animated and request.args.get("animated"):
         if handler.mime == ImageMIME.GIF:
             frames, durations = _rescale_animated_image_frames(
-                image, box, resizeimage.resize_thumbnail
+                image, box, _thumbnail_frame
             )
             info = {
                 key: image.info[key]
@@ -129,7 +202,7 @@ def fit(box: int):
             }
         elif handler.mime == ImageMIME.WEBP:
             frames, durations = _rescale_animated_image_frames(
-                image, box, resizeimage.resize_thumbnail
+                image, box, _thumbnail_frame
             )
             info = {
                 key: image.info[key]
@@ -141,7 +214,7 @@ def fit(box: int):
             }
         elif handler.mime == ImageMIME.PNG:
             frames, durations = _rescale_animated_png_frames(
-                image, box, resizeimage.resize_thumbnail
+                image, box, _thumbnail_frame
             )
             info = {key: image.info[key] for key in ["loop"] if key in image.info} | {
                 "optimize": True,
@@ -151,32 +224,35 @@ def fit(box: int):
             frames = None
 
         if frames:
-            data = _save_animated_frames_data(
-                frames, durations, handler.mime.pil_format, **info
-            )
+            output_format = handler.mime.pil_format
+            data = _save_animated_frames_data(frames, durations, output_format, **info)
         else:
             # Fallback to first frame of animated image
+            output_format = image.format
             data = _rescale_single_frame_image(
                 image,
                 box,
-                image.format,
-                resizeimage.resize_thumbnail,
+                output_format,
+                _thumbnail,
             )
     else:
+        output_format = image.format
         data = _rescale_single_frame_image(
             image,
             box,
-            image.format,
-            resizeimage.resize_thumbnail,
+            output_format,
+            _thumbnail,
         )
     if data is None:
         return error(APIError(message="Error occurred during rescaling"), status=500)
-    resized_content = base64.b64encode(data).decode("utf-8")
-    end = time.time()
+    cost = (time.perf_counter_ns() - started) // 1_000_000
 
-    if request.args.get("simple"):
-        return success(resized_content, mimetype=handler.mime.mime)
+    # Hand back the image itself, skipping the base64 and JSON wrapping.
+    output_mime = ImageMIME.get_by_pil_format(output_format)
+    if _wants_raw_image(output_mime):
+        return success(data, mimetype=output_mime.mime)
 
+    resized_content = base64.b64encode(data).decode("utf-8")
     return success(
         {
             "uploaded": {
@@ -186,8 +262,8 @@ def fit(box: int):
             "status": "ok",
             "success": True,
             "start": start,
-            "end": end,
-            "cost": int((end - start) * 1000),
+            "end": start + cost / 1000,
+            "cost": cost,
             "output": resized_content,
         }
     )
@@ -203,7 +279,7 @@ def fit(box: int):
 )
 def resize_avatar():
     # Check uploaded file is valid or not.
-    received = get_file_bytes()
+    received = get_file_stream()
     if isinstance(received, APIError):
         return error(received)
 
@@ -215,61 +291,72 @@ def resize_avatar():
     # Resize it to each size contained in `AvatarSize`.
 
     start = time.time()
+    started = time.perf_counter_ns()
     avatars = {}
     try:
-        # Confirmation basic avatar to resize.
-        # Try to use max size avatar otherwise use original(rotated).
-        if not handler.is_animated:
-            handler.auto_rotate()
-
         image = handler.image
-        for size in AvatarSize:
-            if size.is_mandatory or _need_rescale(image, size):
-                # Choose rescale function based on format and animation.
-                if handler.is_animated and request.args.get("animated"):
-                    if handler.mime == ImageMIME.GIF or handler.mime == ImageMIME.WEBP:
-                        frames, durations = _rescale_animated_image_frames(
-                            image, size, resizeimage.resize_cover, validate=False
-                        )
-                    elif handler.mime == ImageMIME.PNG:
-                        frames, durations = _rescale_animated_png_frames(
-                            image, size, resizeimage.resize_cover, validate=False
-                        )
-                    else:
-                        frames = None
-
-                    if frames:
-                        data = _save_animated_frames_data(
-                            frames,
-                            durations,
-                            ImageMIME.PNG.pil_format,
-                            loop=0,  # always loop for avatar
-                        )
-                    else:
-                        # Fallback to first frame of animated image
-                        data = _rescale_single_frame_image(
-                            image,
-                            size,
-                            ImageMIME.PNG.pil_format,
-                            resizeimage.resize_cover,
-                            validate=False,
-                        )
-                else:
-                    data = _rescale_single_frame_image(
-                        image,
-                        size,
-                        ImageMIME.PNG.pil_format,
-                        resizeimage.resize_cover,
-                        validate=False,
-                    )
-                avatars[f"avatar{size}"] = {
-                    "size": len(data),
-                    "body": base64.b64encode(data).decode("utf-8"),
-                }
+        animated = handler.is_animated and bool(request.args.get("animated"))
+        output = ImageMIME.WEBP if request.args.get("webp") else ImageMIME.PNG
+        sizes = [
+            size
+            for size in AvatarSize
+            if size.is_mandatory or _need_rescale(image, size)
+        ]
+        frames = None
+        if animated:
+            # Frames are read by seeking the shared image, so decode and crop
+            # each of them only once, to the largest avatar.
+            if handler.mime == ImageMIME.GIF or handler.mime == ImageMIME.WEBP:
+                frames, durations = _rescale_animated_image_frames(
+                    image, sizes[-1], _cover
+                )
+            elif handler.mime == ImageMIME.PNG:
+                frames, durations = _rescale_animated_png_frames(
+                    image, sizes[-1], _cover
+                )
+        if frames:
+            # Cascade each frame down the smaller sizes, then encode the
+            # animation of each size concurrently.
+            save = partial(
+                _save_animated_frames_data,
+                durations=durations,
+                format=output.pil_format,
+                loop=0,  # always loop for avatar
+                **AVATAR_SAVE_OPTIONS[output],
+            )
+            ladders = [_cascade(frame, sizes) for frame in frames]
+            rendered = _avatar_pool.map(save, map(list, zip(*ladders)))
+        else:
+            # Static images, or the first frame of animated ones.
+            # Let libjpeg scale JPEGs down by up to 1/8 while decoding, keeping
+            # twice the target size like the reducing gap of `Image.thumbnail`.
+            image.draft(None, (sizes[-1] * 2, sizes[-1] * 2))
+            # Crop and scale the upload only once, to the largest avatar.
+            largest = _cover(image, (sizes[-1], sizes[-1]))
+            # Avatars are centered squares, so we can rotate the small crop
+            # instead of transposing the full-size upload before scaling.
+            transpose = handler.orientation_transpose
+            # `FLIP_LEFT_RIGHT` is 0, so compare to `None` rather than test truth.
+            if not handler.is_animated and transpose is not None:
+                largest = largest.transpose(transpose)
+            # Cascade down the smaller sizes, each one is resized from the
+            # previous size, then encode them all concurrently.
+            save = partial(
+                _save_single_frame_data,
+                format=output.pil_format,
+                **AVATAR_SAVE_OPTIONS[output],
+            )
+            rendered = _avatar_pool.map(save, _cascade(largest, sizes))
+        for size, data in zip(sizes, rendered):
+            avatars[f"avatar{size}"] = {
+                "size": len(data),
+                "mime": output.mime,
+                "body": base64.b64encode(data).decode("utf-8"),
+            }
     except Exception as e:  # noqa
         capture_exception(e)
         return error(APIError(message=f"Failed to resize the uploaded image file: {e}"))
-    end = time.time()
+    cost = (time.perf_counter_ns() - started) // 1_000_000
 
     return success(
         {
@@ -280,17 +367,42 @@ def resize_avatar():
             "status": "ok",
             "success": True,
             "start": start,
-            "end": end,
-            "cost": int((end - start) * 1000),
+            "end": start + cost / 1000,
+            "cost": cost,
             **avatars,
         }
     )
 
 
-def get_file_bytes() -> APIError | bytes:
+def get_file_stream() -> APIError | BinaryIO:
     if not (_uploaded := request.files.get("file")):
         return APIError(message="No file was uploaded")
-    return _uploaded.read()
+    # Hand over the (maybe spooled to disk) upload without reading it in memory.
+    return _uploaded.stream
+
+
+def _wants_raw_image(mime: ImageMIME) -> bool:
+    """Whether the client asked for the image itself, by `?simple` or `Accept`."""
+    if request.args.get("simple"):
+        return True
+    # JSON wins ties, so `*/*` and a missing `Accept` keep getting JSON.
+    accepted = request.accept_mimetypes.best_match(["application/json", mime.mime])
+    return accepted == mime.mime
+
+
+def _fits_as_is(handler: ImageHandle, box: int) -> bool:
+    """Whether the upload already fits in the box, and can be returned untouched."""
+    image = handler.image
+    if max(image.size) > box or handler.is_animated:
+        return False
+    # These are converted on loading, the upload isn't in the output format.
+    if handler.mime == ImageMIME.SVG or handler.mime in ICON_MIMES:
+        return False
+    # Re-encoding drops the metadata, keep doing it for images carrying any.
+    if image.getexif() or not METADATA_INFO_KEYS.isdisjoint(image.info):
+        return False
+    # PNG text chunks may follow the pixels, reading them loads the image.
+    return not getattr(image, "text", None)
 
 
 def _need_rescale(img: Image.Image, target_size: int) -> bool:
@@ -298,15 +410,56 @@ def _need_rescale(img: Image.Image, target_size: int) -> bool:
     return img.size[0] >= target_size and img.size[1] >= target_size
 
 
+def _thumbnail(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Shrink the image in place to fit in the size, keeping its aspect ratio."""
+    image.thumbnail(size, Image.Resampling.LANCZOS)
+    return image
+
+
+def _thumbnail_frame(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Like `_thumbnail`, but on a copy of the current frame of an animated image."""
+    return _thumbnail(image.copy(), size)
+
+
+def _cover(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Crop the center of the image and scale it to the size in one pass."""
+    # The centered box of the size's aspect ratio, as `ImageOps.fit` crops.
+    width, height = image.size
+    scale = min(width / size[0], height / size[1])
+    crop_width, crop_height = size[0] * scale, size[1] * scale
+    left, top = (width - crop_width) / 2, (height - crop_height) / 2
+    box = (left, top, left + crop_width, top + crop_height)
+    # Unlike `ImageOps.fit`, let large uploads be shrunk by a cheap box reduce
+    # first, down to twice the size, the same gap as `Image.thumbnail` uses.
+    return image.resize(size, Image.Resampling.LANCZOS, box=box, reducing_gap=2.0)
+
+
+def _cascade(image: Image.Image, sizes: List[int]) -> List[Image.Image]:
+    """Scale a square image down to each size, resizing from the next larger one."""
+    ladder = {}
+    for size in sorted(sizes, reverse=True):
+        if image.size != (size, size):
+            image = image.resize((size, size), Image.Resampling.LANCZOS)
+        ladder[size] = image
+    return [ladder[size] for size in sizes]
+
+
 def _rescale_single_frame_image(
-    image: Image.Image, size: int, format: str, resize, **resize_kwargs
+    image: Image.Image, size: int, format: str, resize, **info
 ) -> bytes | None:
+    try:
+        rescaled = resize(image, (size, size))
+    except Exception as e:  # noqa
+        capture_exception(e)
+        return
+    return _save_single_frame_data(rescaled, format, **info)
+
+
+def _save_single_frame_data(image: Image.Image, format: str, **info) -> bytes | None:
     try:
         with io.BytesIO() as io_obj:
-            rescaled = resize(image, (size, size), **resize_kwargs)
-            rescaled.save(io_obj, format=format)
+            image.save(io_obj, format=format, **info)
             return io_obj.getvalue()
-
     except Exception as e:  # noqa
         capture_exception(e)
         return
@@ -1,44 +1,85 @@
 import time
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass
 
+import orjson
 from flask import Blueprint, current_app
+from flask.blueprints import BlueprintSetupState
 
 from remote.wrapper import success
 
 # Please keep the blueprint definition at the top uniformly.
 index_bp = Blueprint("index", __name__)
 
-_started = time.time()
+# On the monotonic clock, so the uptime never jumps along with the wall clock.
+_started = time.monotonic()
+
+# Placeholder of the `uptime` field while pre-serializing the responses below.
+_UPTIME_PLACEHOLDER = "__uptime__"
+
+
+# The body of `/` never changes, serialize it only once.
+_home = orjson.dumps({})
 
 
 @index_bp.route("/")
 def home():
-    return success({})
+    return success(_home)
 
 
 @dataclass
 class Pong:
     status: str = "ok"
     message: str = "pong"
-    uptime: float = field(default_factory=lambda: time.time() - _started)
+    uptime: float = 0.0
     success: bool = True
 
 
-@index_bp.route("/ping")
-def ping():
-    return success(Pong())
-
-
 @dataclass
 class WorkerInfo:
+    uid: str
+    country: str
+    region: str
     status: str = "ok"
-    uid: str = field(default_factory=lambda: current_app.config["UID"])
-    uptime: float = field(default_factory=lambda: time.time() - _started)
-    country: str = field(default_factory=lambda: current_app.config["COUNTRY"])
-    region: str = field(default_factory=lambda: current_app.config["REGION"])
+    uptime: float = 0.0
     success: bool = True
 
 
+class UptimeTemplate:
+    """
+    A pre-serialized JSON response in which only `uptime` changes between requests.
+
+    Everything else in `Pong`/`WorkerInfo` is constant for the lifetime of the app,
+    so we serialize them once and only splice the current uptime in per request.
+    """
+
+    def __init__(self, content):
+        """Serialize `content` once, leaving a slot for `uptime`."""
+        payload = asdict(content) | {"uptime": _UPTIME_PLACEHOLDER}
+        serialized = orjson.dumps(payload)
+        self._head, self._tail = serialized.split(orjson.dumps(_UPTIME_PLACEHOLDER))
+
+    def render(self) -> bytes:
+        uptime = orjson.dumps(time.monotonic() - _started)
+        return b"".join((self._head, uptime, self._tail))
+
+
+_pong = UptimeTemplate(Pong())
+
+
+@index_bp.record_once
+def _prepare_worker_info(state: BlueprintSetupState):
+    config = state.app.config
+    worker_info = WorkerInfo(
+        uid=config["UID"], country=config["COUNTRY"], region=config["REGION"]
+    )
+    state.app.extensions["worker_info"] = UptimeTemplate(worker_info)
+
+
+@index_bp.route("/ping")
+def ping():
+    return success(_pong.render())
+
+
 @index_bp.route("/hello")
 def hello():
-    return success(WorkerInfo())
+    return success(current_app.extensions["worker_info"].render())
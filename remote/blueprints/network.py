@@ -1,27 +1,39 @@
+import os
+import threading
 import time
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from typing import List
+from functools import lru_cache
+from typing import Dict, List, Tuple
 
 import dns.resolver
-import pyipip
+import orjson
+from cachetools import TLRUCache
 from dns.exception import DNSException
 from flask import Blueprint, current_app, request
-from flask.helpers import is_ip
 from sentry_sdk import capture_exception
 
+from remote.utilities.ipip import IPIPIndex, ip_to_int
 from remote.wrapper import APIError, error, success
 
 # Please keep the blueprint definition at the top uniformly.
 network_bp = Blueprint("network", __name__)
 
 _ipdb = None
+# Threaded workers would otherwise load the database once per racing request.
+_ipdb_lock = threading.Lock()
+
+# Max number of serialized `/ipip` responses kept in memory.
+IPIP_CACHE_SIZE = 65536
 
 
 def _get_ipdb():
     global _ipdb
     if not _ipdb:
-        _ipdb = pyipip.IPIPDatabase(current_app.config["IPIP_DB_PATH"])
+        with _ipdb_lock:
+            if not _ipdb:
+                _ipdb = IPIPIndex(current_app.config["IPIP_DB_PATH"])
     return _ipdb
 
 
@@ -45,23 +57,32 @@ IPRecord = namedtuple(
         "continent_code",
     ],
 )
+# Fields looked up from the database, without the two that we own assigned.
+IP_FIELDS = IPRecord._fields[2:]
+
+
+@lru_cache(maxsize=IPIP_CACHE_SIZE)
+def _ipip_body(ip_int: int) -> bytes:
+    """Look up and serialize the IP info, cached since queried IPs repeat a lot."""
+    ip_fields = _get_ipdb().lookup_fields(ip_int)
+    if len(ip_fields) < len(IP_FIELDS):
+        raise ValueError(f"Incomplete IP record: {ip_fields!r}")
+    ip_info = dict(zip(IP_FIELDS, ip_fields), status="ok", success=True)
+    return orjson.dumps(ip_info)
 
 
 @network_bp.route("/ipip/<access_ip>")
 def ipip(access_ip):
-    if ":" in access_ip:
-        return error(APIError(message="IPv6 is not supported"))
-
-    if not is_ip(access_ip):
+    try:
+        ip_int = ip_to_int(access_ip)
+    except OSError:
+        # Only tell IPv6 apart once the address failed to parse as IPv4.
+        if ":" in access_ip:
+            return error(APIError(message="IPv6 is not supported"))
         return error(APIError(message="Invalid IPv4 address provided"))
 
     try:
-        _db = _get_ipdb()
-        ip_fields = _db.lookup(access_ip).split("\t")
-        # Subtract the number of fields that we own assigned.
-        except_ip_meta_length = len(IPRecord._fields) - 2
-        ip_record = IPRecord("ok", True, *ip_fields[:except_ip_meta_length])
-        return success(ip_record._asdict())
+        return success(_ipip_body(ip_int))
     except Exception as e:  # noqa
         capture_exception(e)
         return error(APIError(message="IP info not found"), status=404)
@@ -78,10 +99,11 @@ class UserIP:
 
     def __post_init__(self):
         """We will automatically calculate the remaining fields at this stage."""
-        self.ipv4 = self.extract_ip4(self.ip) if self.is_ipv4 else None
-        self.ipv6 = None if self.is_ipv4 else self.ip
-        self.ipv4_available = self.is_ipv4
-        self.ipv6_available = not self.is_ipv4
+        is_ipv4 = self.is_ipv4
+        self.ipv4 = self.extract_ip4(self.ip) if is_ipv4 else None
+        self.ipv6 = None if is_ipv4 else self.ip
+        self.ipv4_available = is_ipv4
+        self.ipv6_available = not is_ipv4
 
     @property
     def is_ipv4(self) -> bool:
@@ -89,14 +111,15 @@ class UserIP:
 
     @staticmethod
     def extract_ip4(raw_ip: str) -> str:
-        return raw_ip.replace("::ffff:", "")  # noqa
+        return raw_ip.removeprefix("::ffff:")
 
 
 @network_bp.route("/ip")
 def ip():
     _ip = request.remote_addr
     if forwarded := request.headers.get("X-Forwarded-For"):
-        _ip = forwarded
+        # The leftmost address is the client, the rest are the proxies on the way.
+        _ip = forwarded.partition(",")[0].strip()
     return success(UserIP(ip=_ip))
 
 
@@ -113,17 +136,140 @@ class ResolveResp:
         self.status = "ok" if len(self.answers) > 0 else "error"
 
 
+# Max number of DNS answers kept in memory, each one expires along with its TTL.
+DNS_CACHE_SIZE = 10_000
+# But no answer is kept longer than this, however long its TTL is.
+DNS_CACHE_MAX_TTL = 3600
+
+# Answers are cached as text, so a cache hit doesn't format the rrsets again.
+DNSRecord = namedtuple("DNSRecord", ["expiration", "answers"])
+
+_dns_cache = TLRUCache(
+    maxsize=DNS_CACHE_SIZE,
+    ttu=lambda _key, record, now: min(record.expiration, now + DNS_CACHE_MAX_TTL),
+    # `Answer.expiration` is a wall clock timestamp.
+    timer=time.time,
+)
+# `cachetools` caches are not thread-safe.
+_dns_cache_lock = threading.Lock()
+# Queries on their way for a key, so concurrent misses wait for them instead.
+_dns_inflight: Dict[Tuple[str, Tuple[str, ...]], Future] = {}
+
+
+# Seconds to wait for each nameserver, and in total for a query.
+DNS_TIMEOUT = 1.0
+DNS_LIFETIME = 2.0
+
+# Request threads of a gunicorn worker, which may all be querying at once.
+DNS_CONCURRENT_REQUESTS = 8
+
+_dns_pool = None
+_dns_pool_lock = threading.Lock()
+
+
+def _get_dns_pool(nameservers: List[str]) -> ThreadPoolExecutor:
+    """Get a pool large enough for every request thread to race all the nameservers.
+
+    Running queries can't be cancelled, so a dead nameserver keeps its thread until
+    `DNS_LIFETIME` runs out. With a thread for each, it never holds up other queries.
+    """
+    global _dns_pool
+    if not _dns_pool:
+        with _dns_pool_lock:
+            if not _dns_pool:
+                _dns_pool = ThreadPoolExecutor(
+                    max_workers=DNS_CONCURRENT_REQUESTS * len(nameservers),
+                    thread_name_prefix="dns",
+                )
+    return _dns_pool
+
+
+def _forget_dns_pool():
+    """Threads don't survive a fork, let the child process create its own pool."""
+    global _dns_pool, _dns_pool_lock
+    _dns_pool = None
+    _dns_pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_dns_pool)
+
+
+@lru_cache
+def _get_resolver(nameservers: Tuple[str, ...]) -> dns.resolver.Resolver:
+    """Share one resolver per nameservers, they are safe to use across threads."""
+    # We always set nameservers, no need to read `/etc/resolv.conf`.
+    local_resolver = dns.resolver.Resolver(configure=False)
+    local_resolver.nameservers = list(nameservers)
+    local_resolver.timeout = DNS_TIMEOUT
+    local_resolver.lifetime = DNS_LIFETIME
+    return local_resolver
+
+
+def _resolve(domain: str, nameservers: List[str]) -> DNSRecord:
+    """Resolve the domain, reusing the answer until its TTL runs out."""
+    key = (domain, tuple(nameservers))
+    with _dns_cache_lock:
+        if record := _dns_cache.get(key):
+            return record
+        inflight = _dns_inflight.get(key)
+        if not inflight:
+            inflight = _dns_inflight[key] = Future()
+            leading = True
+        else:
+            leading = False
+    if not leading:
+        return inflight.result()
+
+    try:
+        answer = _query(domain, nameservers)
+        record = DNSRecord(
+            expiration=answer.expiration,
+            answers=[rrset.to_text() for rrset in answer],
+        )
+    except Exception as e:  # noqa
+        with _dns_cache_lock:
+            del _dns_inflight[key]
+        inflight.set_exception(e)
+        raise
+    with _dns_cache_lock:
+        _dns_cache[key] = record
+        del _dns_inflight[key]
+    inflight.set_result(record)
+    return record
+
+
+def _query(domain: str, nameservers: List[str]) -> dns.resolver.Answer:
+    """Query all the nameservers in parallel, and take the first answer."""
+    if not nameservers:
+        raise dns.resolver.NoNameservers()
+
+    pool = _get_dns_pool(nameservers)
+    futures = [
+        pool.submit(_get_resolver((nameserver,)).resolve, domain)
+        for nameserver in nameservers
+    ]
+    exception = None
+    for future in as_completed(futures):
+        try:
+            answer = future.result()
+        except DNSException as e:
+            exception = e
+            continue
+        for pending in futures:
+            pending.cancel()
+        return answer
+    raise exception
+
+
 @network_bp.route("/dns/resolve")
 def resolve():
     if not (domain := request.args.get("domain")):
         api_error = APIError(message='Required parameter "domain" is missing or empty')
         return error(api_error)
 
-    local_resolver = dns.resolver.Resolver()
     nameservers = current_app.config["NAMESERVERS"]
-    local_resolver.nameservers = nameservers
     try:
-        dns_answer = local_resolver.resolve(domain)
+        dns_record = _resolve(domain, nameservers)
     except DNSException:
         return error(
             APIError(message=f"Unable to resolve the specified domain: {domain}")
@@ -131,7 +277,7 @@ def resolve():
 
     resolve_resp = ResolveResp(
         nameservers=nameservers,
-        ttl=dns_answer.expiration - time.time(),
-        answers=[rrset.to_text() for rrset in dns_answer],
+        ttl=dns_record.expiration - time.time(),
+        answers=dns_record.answers,
     )
     return success(resolve_resp)
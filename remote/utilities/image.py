@@ -1,7 +1,6 @@
-import base64
 import io
 from enum import Enum, IntEnum, unique
-from typing import Optional
+from typing import BinaryIO, Optional
 
 import cairosvg
 import magic
@@ -77,11 +76,44 @@ class ImageMIME(Enum):
 
     @classmethod
     def get_by_magic_format(cls, value: str) -> "ImageMIME":
-        return next((i for i in cls if i.value[0] == value), None)
+        return MIMES_BY_MAGIC_FORMAT.get(value)
 
     @classmethod
     def get_by_pil_format(cls, value: str) -> "ImageMIME":
-        return next((i for i in cls if i.value[1] == value), None)
+        return MIMES_BY_PIL_FORMAT.get(value)
+
+    @classmethod
+    def get_by_signature(cls, buffer: bytes) -> Optional["ImageMIME"]:
+        return next((i for sig, i in SIGNATURES if buffer.startswith(sig)), None)
+
+
+# Lookup tables of the formats above, the first declared MIME wins on duplicates.
+MIMES_BY_MAGIC_FORMAT = {i.mime: i for i in reversed(ImageMIME)}
+MIMES_BY_PIL_FORMAT = {i.pil_format: i for i in reversed(ImageMIME)}
+
+# Icon formats, which are scaled up by integer multiples on loading.
+ICON_MIMES = frozenset(
+    [
+        ImageMIME.ICO,
+        ImageMIME.ICO_UNOFFICIAL,
+        ImageMIME.ICNS,
+        ImageMIME.X_ICNS,
+    ]
+)
+
+# File signatures of the most common uploads, checked before asking libmagic.
+SIGNATURES = (
+    (b"\xff\xd8\xff", ImageMIME.JPEG),
+    (b"\x89PNG\r\n\x1a\n", ImageMIME.PNG),
+    (b"GIF87a", ImageMIME.GIF),
+    (b"GIF89a", ImageMIME.GIF),
+)
+
+# libmagic only needs the header of an image to identify it.
+MAGIC_HEADER_SIZE = 4096
+# Except SVGs with a long XML prologue (comments, a DOCTYPE), reported as text.
+MAGIC_TEXT_FORMATS = frozenset(["text/xml", "text/plain"])
+MAGIC_TEXT_HEADER_SIZE = 1024 * 1024
 
 
 class ExifTag(Enum):
@@ -94,6 +126,18 @@ class ExifTag(Enum):
     ...
 
 
+# Transposes undoing each EXIF orientation, as `PIL.ImageOps.exif_transpose` does.
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
 @unique
 class AvatarSize(IntEnum):
     MINI = 24
@@ -109,17 +153,19 @@ class AvatarSize(IntEnum):
 
     @property
     def is_mandatory(self):
-        return self in [
-            self.MINI.value,
-            self.NORMAL.value,
-            self.LARGE.value,
-        ]
+        return self in (self.MINI, self.NORMAL, self.LARGE)
 
 
 class ImageHandle:
-    def __init__(self, content: bytes):
-        """Image handle."""
-        self._raw_content: bytes = content
+    def __init__(self, content: bytes | BinaryIO):
+        """Image handle, of the raw bytes or a seekable binary stream of an image."""
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+        # We read from the stream directly instead of copying it into memory,
+        # so `PIL` can decode large uploads spooled to disk by `werkzeug` lazily.
+        self._stream: BinaryIO = content
+        self._raw_size: int = content.seek(0, io.SEEK_END)
+        content.seek(0)
         self.mime: Optional[ImageMIME] = None
         self.image: Image.Image = None
         self.preprocess()
@@ -134,55 +180,64 @@ class ImageHandle:
 
     @property
     def raw_size(self) -> int:
-        return len(self._raw_content)
+        return self._raw_size
+
+    @property
+    def raw_content(self) -> bytes:
+        """The uploaded bytes, as they are."""
+        self._stream.seek(0)
+        return self._stream.read()
 
     @property
     def frames(self) -> int:
         return getattr(self.image, "n_frames", 1)
 
     @property
-    def b64_content(self, mime: ImageMIME = ImageMIME.JPEG) -> Optional[str]:
+    def orientation_transpose(self) -> Optional[Image.Transpose]:
+        """The transpose to undo the EXIF orientation, `None` if image is upright."""
+        if self.image is None:
+            return None
+        orientation = self.image.getexif().get(ExifTag.ORIENTATION.value)
+        return ORIENTATION_TRANSPOSE.get(orientation)
+
+    def encode(self, mime: ImageMIME = ImageMIME.JPEG, **info) -> Optional[bytes]:
+        """Encode the image into bytes of the given format, with encoder options."""
         if self.image is None:
             return None
         with io.BytesIO() as buffered:
-            self.image.save(buffered, format=mime.name)
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
+            self.image.save(buffered, format=mime.name, **info)
+            return buffered.getvalue()
 
     def preprocess(self):
         """Convert rare image formats into formats supported by PIL."""
-        self.mime = self.guess_mime_from_bytes(self._raw_content)
+        self.mime = self.guess_mime_from_stream(self._stream)
         if not self.mime:
             current_app.logger.info("No MIME type found, skip the preparation process.")
             return
 
         # PIL only support rasterized image formats, convert SVG to PNG first.
-        raw_content = self._raw_content
+        raw_content = self._stream
         if self.mime == ImageMIME.SVG:
             try:
-                raw_content = cairosvg.svg2png(self._raw_content, dpi=300)
+                raw_content = io.BytesIO(cairosvg.svg2png(self._stream.read(), dpi=300))
             except Exception as e:  # noqa
                 capture_exception(e)
 
         try:
-            image = self.load_from_bytes(raw_content)
+            image = self.load_from_stream(raw_content)
         except Exception:  # noqa
-            current_app.logger.error("Failed to load image from bytes.")
+            current_app.logger.error("Failed to load image from stream.")
             return
 
         # Preprocess rare image types.
-        ico_mimes = [
-            ImageMIME.ICO,
-            ImageMIME.ICO_UNOFFICIAL,
-            ImageMIME.ICNS,
-            ImageMIME.X_ICNS,
-        ]
-        if self.mime in ico_mimes:
+        if self.mime in ICON_MIMES:
             # Integer scaling for ICO icons.
             max_size = max(AvatarSize)
             self.image = image.resize((max_size, max_size), Image.NEAREST)
             self.image.format = ImageMIME.PNG.pil_format
-        elif self.mime == ImageMIME.SVG:
-            # Letterbox rasterized SVG in a square.
+        elif self.mime == ImageMIME.SVG and image.width != image.height:
+            # Letterbox rasterized SVG in a square, square ones are kept as is
+            # to skip compositing them onto a copy of the same size.
             w, h = image.size
             background = Image.new("RGBA", (max(w, h), max(w, h)), (0, 0, 0, 0))
             is_horizontal = w > h
@@ -199,24 +254,39 @@ class ImageHandle:
             self.image.format = self.mime.pil_format
 
     @staticmethod
-    def guess_mime_from_bytes(buffer: bytes) -> ImageMIME | None:
-        """Try to guess the mime type from bytes content by `magic` or `PIL`."""
-        magic_format = pil_format = None
+    def guess_mime_from_stream(stream: BinaryIO) -> ImageMIME | None:
+        """Try to guess the mime type from a binary stream by `magic` or `PIL`."""
+        header = stream.read(MAGIC_HEADER_SIZE)
+        stream.seek(0)
+        if mime := ImageMIME.get_by_signature(header):
+            return mime
+
+        # Empty until guessed, so the lookups below need no `None` checks.
+        magic_format = pil_format = ""
         try:
-            magic_format = magic.from_buffer(buffer, mime=True)
+            magic_format = magic.from_buffer(header, mime=True)
             # magic_format eg: "image/jpeg"
-        except magic.MagicException as e:
-            current_app.logger.warning("Magic unable to guess mime type: %s", e.message)
+            if magic_format in MAGIC_TEXT_FORMATS and len(header) == MAGIC_HEADER_SIZE:
+                header = stream.read(MAGIC_TEXT_HEADER_SIZE)
+                stream.seek(0)
+                magic_format = magic.from_buffer(header, mime=True)
+        except magic.MagicException:
+            current_app.logger.warning("Magic unable to guess mime type", exc_info=True)
 
         if mime := ImageMIME.get_by_magic_format(magic_format.lower()):
             return mime
+        # libmagic gives up looking for the `<svg` root after the first few KiB.
+        if magic_format in MAGIC_TEXT_FORMATS and b"<svg" in header:
+            return ImageMIME.SVG
 
         try:
-            _image = Image.open(io.BytesIO(buffer))
+            _image = Image.open(stream)
             pil_format = _image.format
             # pil_format eg: "AVIF"
-        except (UnidentifiedImageError, AttributeError) as e:
-            current_app.logger.warning("Magic unable to guess mime type: %s", e.message)
+        except (UnidentifiedImageError, AttributeError):
+            current_app.logger.warning("PIL unable to guess mime type", exc_info=True)
+        finally:
+            stream.seek(0)
 
         if mime := ImageMIME.get_by_pil_format(pil_format.upper()):
             return mime
@@ -226,9 +296,9 @@ class ImageHandle:
         )
 
     @staticmethod
-    def load_from_bytes(bytes_content: bytes) -> Image.Image:
-        """Convert bytes content to `PIL.Image`."""
-        return Image.open(io.BytesIO(bytes_content))
+    def load_from_stream(stream: BinaryIO) -> Image.Image:
+        """Open a binary stream as `PIL.Image`, pixels are decoded lazily."""
+        return Image.open(stream)
 
     def remove_exif(self, *tags: ExifTag, full: bool = False):
         """Remove GPS data from the image EXIF."""
@@ -0,0 +1,82 @@
+import array
+import socket
+import struct
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+import pyipip
+
+# Width of the prefix used to index the ranges, the same stride as `.datx` indexes.
+PREFIX_BITS = 16
+
+
+def ip_to_int(ip: str) -> int:
+    """
+    Convert a dotted IPv4 address to its 32-bit integer form.
+
+    Raise `OSError` if it is not a valid IPv4 address, unlike `inet_aton`,
+    `inet_pton` rejects the shorthand forms like `127.1`.
+    """
+    return struct.unpack("!I", socket.inet_pton(socket.AF_INET, ip))[0]
+
+
+class IPIPIndex(pyipip.IPIPDatabase):
+    """
+    IPIP database with a prefix index and pre-split records.
+
+    `pyipip` bisects the whole range table and hands back a tab separated string
+    on every lookup. We build two things once at load time instead:
+
+    1. A 16-bit prefix table, so each lookup only bisects the handful of ranges
+       sharing the prefix of the target address.
+    2. The records split into tuples, so the response path does no `.split()`.
+       They replace the joined string and offsets `pyipip` keeps in memory.
+    """
+
+    def __init__(self, filename: str):
+        """Load the database and build the index."""
+        self._prefixes = array.array("I")
+        self._records: List[Tuple[str, ...]] = []
+        super().__init__(filename)
+
+    def load_db(self):
+        super().load_db()
+        self._build_prefixes()
+        self._build_records()
+        # The records hold the split strings now, release the joined copy of them.
+        self._offsets = array.array("I")
+        self._strings = ""
+
+    def _build_prefixes(self):
+        ranges = self._ranges
+        self._prefixes = array.array(
+            "I",
+            (
+                bisect_left(ranges, prefix << (32 - PREFIX_BITS))
+                for prefix in range((1 << PREFIX_BITS) + 1)
+            ),
+        )
+
+    def _build_records(self):
+        # Ranges often share a record, split each distinct record only once.
+        split: Dict[int, Tuple[str, ...]] = {}
+        offsets, strings = self._offsets, self._strings
+        for i in range(len(self._ranges)):
+            start, end = offsets[2 * i], offsets[2 * i + 1]
+            if start not in split:
+                split[start] = tuple(strings[start:end].split("\t"))
+            self._records.append(split[start])
+
+    def _locate(self, n: int) -> int:
+        prefix = n >> (32 - PREFIX_BITS)
+        # The range covering `n` ends at or after `prefix`, and no later than
+        # the first range ending at or after the next prefix.
+        lo, hi = self._prefixes[prefix], self._prefixes[prefix + 1]
+        return bisect_left(self._ranges, n, lo, hi)
+
+    def lookup(self, ip: str) -> str:
+        return "\t".join(self._records[self._locate(ip_to_int(ip))])
+
+    def lookup_fields(self, ip_int: int) -> Tuple[str, ...]:
+        """Look up the record of the IPv4 integer, already split into fields."""
+        return self._records[self._locate(ip_int)]
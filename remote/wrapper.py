@@ -1,9 +1,10 @@
-from dataclasses import asdict, dataclass, is_dataclass
+from dataclasses import dataclass, is_dataclass
 from enum import Enum, unique
 from functools import partial, wraps
 from typing import Any
 
-from flask import Response, json, request
+import orjson
+from flask import Response, request
 
 
 @unique
@@ -58,11 +59,12 @@ class MIMEType(Enum):
 
 
 def _response(content: Any, status: int, mime_type: MIMEType = MIMEType.JSON, **kwargs):
-    if is_dataclass(content):
-        content = json.dumps(asdict(content))
-    elif isinstance(content, dict):
-        content = json.dumps(content)
-    return Response(response=content, status=status, mimetype=mime_type.value, **kwargs)
+    # `orjson` serializes dataclasses natively, no need to `asdict` them first.
+    if is_dataclass(content) or isinstance(content, dict):
+        content = orjson.dumps(content)
+    # A raw `mimetype` takes precedence, for contents not covered by `MIMEType`.
+    kwargs.setdefault("mimetype", mime_type.value)
+    return Response(response=content, status=status, **kwargs)
 
 
 # Shortcut for error response with default http code 400.
@@ -2,9 +2,9 @@ import base64
 import io
 from unittest.mock import patch
 
-from PIL import Image
+from PIL import Image, ImageChops, ImageOps, ImageStat
 
-from remote.utilities.image import AvatarSize
+from remote.utilities.image import AvatarSize, ExifTag
 from tests.fixture import TestFixture
 from tests.test_app import TestBase
 
@@ -126,6 +126,21 @@ class TestImage(TestBase, TestFixture):
 
         output_img = Image.open(io.BytesIO(base64.b64decode(resp["output"])))
         self.assertEqual(output_img.getexif(), {})
+        # Re-encoded with the same quality as the upload.
+        self.assertEqual(
+            output_img.quantization, Image.open(self.hello_jpeg).quantization
+        )
+
+    def test_prepare_jpeg_simple(self):
+        with open(self.hello_jpeg, "rb") as image_file:
+            data = {"file": (image_file, "hello.jpeg")}
+            response = self.client.post("/images/prepare_jpeg?simple=1", data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/jpeg")
+
+        output_img = Image.open(io.BytesIO(response.data))
+        self.assertEqual(output_img.format, "JPEG")
+        self.assertEqual(output_img.getexif(), {})
 
     def test_prepare_jpeg_error_1(self):
         response = self.client.post("/images/prepare_jpeg")
@@ -183,6 +198,40 @@ class TestImage(TestBase, TestFixture):
         output_img = Image.open(io.BytesIO(base64.b64decode(resp["output"])))
         self.assertEqual(output_img.size, _target_size)
 
+    def test_fit_simple(self):
+        target_size = 36
+        with open(self.hello_png, "rb") as image_file:
+            data = {"file": (image_file, "hello.png")}
+            response = self.client.post(
+                f"/images/fit/{target_size}?simple=1", data=data
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/png")
+
+        output_img = Image.open(io.BytesIO(response.data))
+        self.assertEqual(output_img.format, "PNG")
+        self.assertLessEqual(max(output_img.size), target_size)
+
+    def test_fit_accept_image(self):
+        target_size = 36
+        with open(self.hello_png, "rb") as image_file:
+            data = {"file": (image_file, "hello.png")}
+            response = self.client.post(
+                f"/images/fit/{target_size}",
+                data=data,
+                headers={"Accept": "image/png"},
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/png")
+
+        with open(self.hello_png, "rb") as image_file:
+            data = {"file": (image_file, "hello.png")}
+            response = self.client.post(
+                f"/images/fit/{target_size}", data=data, headers={"Accept": "*/*"}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("output", response.json)
+
     def test_fit_avif_320(self):
         target_size = 320
         original_size = Image.open(self.cap_avif).size
@@ -375,6 +424,30 @@ class TestImage(TestBase, TestFixture):
         output_img = Image.open(io.BytesIO(base64.b64decode(resp["output"])))
         self.assertEqual(output_img.size, original_size)
 
+    def test_fit_untouched(self):
+        with open(self.px1_png, "rb") as image_file:
+            original = image_file.read()
+            image_file.seek(0)
+            data = {"file": (image_file, "1px.png")}
+            response = self.client.post("/images/fit/2048?simple=1", data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/png")
+        self.assertEqual(response.data, original)
+
+    def test_fit_metadata(self):
+        # Carries XMP, in an iTXt chunk.
+        with open(self.hello_png, "rb") as image_file:
+            original = image_file.read()
+            image_file.seek(0)
+            data = {"file": (image_file, "hello.png")}
+            response = self.client.post("/images/fit/2048?simple=1", data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/png")
+        # Re-encoded, dropping the XMP instead of passing it on.
+        self.assertNotEqual(response.data, original)
+        fitted = Image.open(io.BytesIO(response.data))
+        self.assertNotIn("XML:com.adobe.xmp", fitted.info)
+
     def test_fit_error_1(self):
         response = self.client.post("/images/fit/320")
         self.assertEqual(response.status_code, 400)
@@ -532,6 +605,76 @@ class TestImage(TestBase, TestFixture):
         self.assertNotIn("avatar256", resp)
         self.assertNotIn("avatar512", resp)
 
+    def test_resize_avatar_exif_orientation(self):
+        # A different color in each quadrant, so every orientation looks different.
+        image = Image.new("RGB", (256, 256), (255, 0, 0))
+        image.paste((0, 255, 0), (128, 0, 256, 128))
+        image.paste((0, 0, 255), (0, 128, 128, 256))
+        image.paste((255, 255, 0), (128, 128, 256, 256))
+        for orientation in range(2, 9):
+            with self.subTest(orientation=orientation):
+                exif = Image.Exif()
+                exif[ExifTag.ORIENTATION.value] = orientation
+                with io.BytesIO() as buffered:
+                    image.save(buffered, format="JPEG", exif=exif.tobytes())
+                    uploaded = buffered.getvalue()
+                data = {"file": (io.BytesIO(uploaded), "rotated.jpeg")}
+                response = self.client.post("/images/resize_avatar", data=data)
+                self.assertEqual(response.status_code, 200)
+
+                body = base64.b64decode(response.json["avatar128"]["body"])
+                im = Image.open(io.BytesIO(body)).convert("RGB")
+                self.assertEqual(im.size, (128, 128))
+                # Displayed the same way as the upload transposed by Pillow.
+                expected = ImageOps.exif_transpose(Image.open(io.BytesIO(uploaded)))
+                expected = expected.convert("RGB").resize(im.size)
+                diff = ImageStat.Stat(ImageChops.difference(im, expected)).mean
+                self.assertLess(max(diff), 16)
+
+    def test_resize_avatar_webp(self):
+        with open(self.hello_png, "rb") as image_file:
+            data = {"file": (image_file, "hello.png")}
+            response = self.client.post("/images/resize_avatar?webp=1", data=data)
+        self.assertEqual(response.status_code, 200)
+
+        resp = response.json
+        for size in [AvatarSize.MINI, AvatarSize.NORMAL, AvatarSize.LARGE]:
+            body = base64.b64decode(resp[f"avatar{size}"]["body"])
+            im = Image.open(io.BytesIO(body))
+            self.assertEqual(im.size, (size, size))
+            self.assertEqual(im.format, "WEBP")
+            self.assertEqual(resp[f"avatar{size}"]["mime"], "image/webp")
+
+    def test_resize_avatar_large_jpeg(self):
+        image = Image.new("RGB", (4000, 3000), (0, 128, 255))
+        with io.BytesIO() as buffered:
+            image.save(buffered, format="JPEG")
+            data = {"file": (io.BytesIO(buffered.getvalue()), "large.jpeg")}
+        response = self.client.post("/images/resize_avatar", data=data)
+        self.assertEqual(response.status_code, 200)
+
+        resp = response.json
+        for size in AvatarSize:
+            body = base64.b64decode(resp[f"avatar{size}"]["body"])
+            im = Image.open(io.BytesIO(body))
+            self.assertEqual(im.size, (size, size))
+
+    def test_resize_avatar_animated_webp_output(self):
+        with open(self.animated_gif, "rb") as image_file:
+            data = {"file": (image_file, "animated.gif")}
+            response = self.client.post(
+                "/images/resize_avatar?animated=1&webp=1", data=data
+            )
+        self.assertEqual(response.status_code, 200)
+
+        resp = response.json
+        for size in [AvatarSize.MINI, AvatarSize.NORMAL, AvatarSize.LARGE]:
+            body = base64.b64decode(resp[f"avatar{size}"]["body"])
+            im = Image.open(io.BytesIO(body))
+            self.assertTrue(getattr(im, "is_animated", False))
+            self.assertEqual(im.size, (size, size))
+            self.assertEqual(im.format, "WEBP")
+
     def test_resize_avatar_animated_gif(self):
         with open(self.animated_gif, "rb") as image_file:
             data = {"file": (image_file, "animated.gif")}
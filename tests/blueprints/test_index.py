@@ -1,3 +1,5 @@
+import time
+
 from tests.test_app import TestBase
 
 
@@ -24,3 +26,10 @@ class TestIndex(TestBase):
         _json_body = response.json
         self.assertIn("region", _json_body)
         self.assertEqual(True, _json_body["success"])
+
+    def test_uptime_keeps_counting(self):
+        for uri in ["/ping", "/hello"]:
+            first = self.client.get(uri).json["uptime"]
+            time.sleep(0.01)
+            second = self.client.get(uri).json["uptime"]
+            self.assertGreater(second, first)
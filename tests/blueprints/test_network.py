@@ -1,9 +1,11 @@
-from unittest.mock import patch
+import threading
+import time
+from unittest.mock import MagicMock, patch
 
-import pyipip
 from dns.exception import DNSException
 
-from remote.blueprints.network import IPRecord
+from remote.blueprints.network import IPRecord, _dns_cache, _ipip_body
+from remote.utilities.ipip import IPIPIndex
 from tests.test_app import TestBase
 
 
@@ -11,6 +13,12 @@ class TestNetwork(TestBase):
     _test_domain = "example.com"
     _test_ip = "127.0.0.1"
 
+    def setUp(self):
+        super().setUp()
+        # Don't let responses cached by other tests leak into this one.
+        _ipip_body.cache_clear()
+        _dns_cache.clear()
+
     def test_ip(self):
         response = self.client.get("/ip")
         self.assertEqual(response.status_code, 200)
@@ -21,12 +29,22 @@ class TestNetwork(TestBase):
         self.assertIn("ipv4", _json_body)
         self.assertIn("ipv6_available", _json_body)
 
+    def test_ip_forwarded(self):
+        headers = {"X-Forwarded-For": "1.2.3.4, 5.6.7.8, 10.0.0.1"}
+        response = self.client.get("/ip", headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        _json_body = response.json
+        self.assertEqual(_json_body["ip"], "1.2.3.4")
+        self.assertEqual(_json_body["ipv4"], "1.2.3.4")
+        self.assertTrue(_json_body["ipv4_available"])
+
     def test_ipip(self):
         ipdb_func = "remote.blueprints.network._get_ipdb"
-        mock_func = "remote.blueprints.network.pyipip.IPIPDatabase.lookup"
-        fake_ip_fields = "\t".join(map(str, range(len(IPRecord._fields) - 2)))
+        mock_func = "remote.blueprints.network.IPIPIndex.lookup_fields"
+        fake_ip_fields = tuple(map(str, range(len(IPRecord._fields) - 2)))
         with (
-            patch(ipdb_func, return_value=pyipip.IPIPDatabase),
+            patch(ipdb_func, return_value=IPIPIndex),
             patch(mock_func, return_value=fake_ip_fields),
         ):
             response = self.client.get(f"/ipip/{self._test_ip}")
@@ -39,6 +57,20 @@ class TestNetwork(TestBase):
         self.assertIn("cn_division_code", _json_body)
         self.assertEqual(set(_json_body.keys()), set(IPRecord._fields))
 
+    def test_ipip_cached(self):
+        ipdb_func = "remote.blueprints.network._get_ipdb"
+        mock_func = "remote.blueprints.network.IPIPIndex.lookup_fields"
+        fake_ip_fields = tuple(map(str, range(len(IPRecord._fields) - 2)))
+        with (
+            patch(ipdb_func, return_value=IPIPIndex),
+            patch(mock_func, return_value=fake_ip_fields) as lookup,
+        ):
+            first = self.client.get(f"/ipip/{self._test_ip}")
+            second = self.client.get(f"/ipip/{self._test_ip}")
+
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(first.json, second.json)
+
     def test_ipip_error_1(self):
         response = self.client.get("/ipip/FF:FF")
 
@@ -59,6 +91,12 @@ class TestNetwork(TestBase):
         self.assertEqual(_json_body["status"], "error")
         self.assertFalse(_json_body["success"])
 
+    def test_ipip_error_shorthand(self):
+        response = self.client.get("/ipip/127.1")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Invalid", response.json["message"])
+
     def test_ipip_error_3(self):
         ipdb_func = "remote.blueprints.network._get_ipdb"
         with patch(ipdb_func, side_effect=Exception("Mock Exception")):
@@ -71,6 +109,19 @@ class TestNetwork(TestBase):
         self.assertEqual(_json_body["status"], "error")
         self.assertFalse(_json_body["success"])
 
+    def test_ipip_short_record(self):
+        ipdb_func = "remote.blueprints.network._get_ipdb"
+        mock_func = "remote.blueprints.network.IPIPIndex.lookup_fields"
+        fake_ip_fields = ("China", "Beijing")
+        with (
+            patch(ipdb_func, return_value=IPIPIndex),
+            patch(mock_func, return_value=fake_ip_fields),
+        ):
+            response = self.client.get(f"/ipip/{self._test_ip}")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("not found", response.json["message"])
+
     def test_resolve(self):
         response = self.client.get(f"/dns/resolve?domain={self._test_domain}")
         self.assertEqual(response.status_code, 200)
@@ -99,3 +150,75 @@ class TestNetwork(TestBase):
         self.assertEqual("error", _json_body["status"])
         self.assertFalse(_json_body["success"])
         self.assertIn("Unable", _json_body["message"])
+
+    def test_resolve_all_failed(self):
+        mock_func = "remote.blueprints.network.dns.resolver.Resolver.resolve"
+        nameservers = self.app.config["NAMESERVERS"]
+        with patch(mock_func, side_effect=DNSException("Mock Exception")) as resolve:
+            response = self.client.get(f"/dns/resolve?domain={self._test_domain}")
+
+        self.assertEqual(resolve.call_count, len(nameservers))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Unable", response.json["message"])
+
+    def test_resolve_no_nameservers(self):
+        self.app.config["NAMESERVERS"] = []
+        response = self.client.get(f"/dns/resolve?domain={self._test_domain}")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Unable", response.json["message"])
+
+    def test_resolve_first_answer(self):
+        mock_func = "remote.blueprints.network.dns.resolver.Resolver.resolve"
+        fake_answer = MagicMock(expiration=time.time() + 60)
+        fake_answer.__iter__.return_value = []
+        # Only one of the nameservers answers, the others fail.
+        side_effect = [DNSException("Mock Exception")] * 2 + [fake_answer]
+        with patch(mock_func, side_effect=side_effect):
+            response = self.client.get(f"/dns/resolve?domain={self._test_domain}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["answers"], [])
+
+    def test_resolve_cached(self):
+        mock_func = "remote.blueprints.network.dns.resolver.Resolver.resolve"
+        fake_answer = MagicMock(expiration=time.time() + 60)
+        fake_answer.__iter__.return_value = []
+        with patch(mock_func, return_value=fake_answer) as resolve:
+            first = self.client.get(f"/dns/resolve?domain={self._test_domain}")
+            queried = resolve.call_count
+            second = self.client.get(f"/dns/resolve?domain={self._test_domain}")
+
+        self.assertEqual(resolve.call_count, queried)
+        self.assertEqual(first.json["answers"], second.json["answers"])
+        self.assertLessEqual(second.json["ttl"], first.json["ttl"])
+
+    def test_resolve_coalesced(self):
+        fake_answer = MagicMock(expiration=time.time() + 60)
+        fake_answer.__iter__.return_value = []
+        started, release = threading.Event(), threading.Event()
+
+        def slow_query(_domain, _nameservers):
+            started.set()
+            release.wait(5)
+            return fake_answer
+
+        responses = []
+
+        def get():
+            client = self.app.test_client()
+            responses.append(client.get(f"/dns/resolve?domain={self._test_domain}"))
+
+        with patch("remote.blueprints.network._query", side_effect=slow_query) as query:
+            first = threading.Thread(target=get)
+            first.start()
+            started.wait(5)
+            # The second request misses the cache while the first one is querying.
+            second = threading.Thread(target=get)
+            second.start()
+            time.sleep(0.1)
+            release.set()
+            first.join(5)
+            second.join(5)
+
+        query.assert_called_once()
+        self.assertEqual([response.status_code for response in responses], [200, 200])
@@ -0,0 +1,47 @@
+import io
+import unittest
+
+from remote.utilities.image import ImageHandle, ImageMIME
+from tests.fixture import TestFixture
+from tests.test_app import TestBase
+
+
+class TestImageMIME(unittest.TestCase, TestFixture):
+    def test_get_by_signature(self):
+        fixtures = {
+            self.hello_jpeg: ImageMIME.JPEG,
+            self.hello_png: ImageMIME.PNG,
+            self.animated_gif: ImageMIME.GIF,
+            self.test_webp: None,
+            self.python_svg: None,
+        }
+        for path, mime in fixtures.items():
+            with open(path, "rb") as image_file:
+                signature = ImageMIME.get_by_signature(image_file.read())
+            self.assertEqual(signature, mime, path)
+
+    def test_get_by_format(self):
+        # Formats shared by several MIMEs resolve to the first declared one.
+        self.assertEqual(ImageMIME.get_by_magic_format("image/bmp"), ImageMIME.BMP)
+        self.assertEqual(ImageMIME.get_by_pil_format("PNG"), ImageMIME.PNG)
+        self.assertEqual(ImageMIME.get_by_pil_format("ICO"), ImageMIME.ICO)
+        self.assertIsNone(ImageMIME.get_by_magic_format("text/plain"))
+        self.assertIsNone(ImageMIME.get_by_pil_format("PDF"))
+
+
+class TestImageHandle(TestBase, TestFixture):
+    def test_guess_mime_long_svg_prologue(self):
+        with open(self.python_svg, "rb") as image_file:
+            svg = image_file.read()
+        # Push the `<svg` root past the header libmagic is first given.
+        comment = b"<!-- " + b"x" * 8192 + b" -->\n"
+        root = svg.index(b"<svg")
+        stream = io.BytesIO(svg[:root] + comment + svg[root:])
+        with self.app.app_context():
+            self.assertEqual(ImageHandle.guess_mime_from_stream(stream), ImageMIME.SVG)
+        self.assertEqual(stream.tell(), 0)
+
+    def test_guess_mime_text(self):
+        stream = io.BytesIO(b"<?xml version='1.0'?>\n<html/>\n" + b" " * 8192)
+        with self.app.app_context():
+            self.assertIsNone(ImageHandle.guess_mime_from_stream(stream))
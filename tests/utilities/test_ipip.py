@@ -0,0 +1,70 @@
+import struct
+import tempfile
+import unittest
+from socket import inet_aton
+
+import pyipip
+
+from remote.utilities.ipip import IPIPIndex, ip_to_int
+
+
+def _build_dat(records):
+    """Build a minimal `.dat` IPIP database from `(last_ip, text)` pairs."""
+    index_size = 256 * 4
+    texts, entries, offset = b"", b"", 0
+    for last_ip, text in records:
+        encoded = text.encode("utf-8")
+        entries += inet_aton(last_ip) + struct.pack("<L", offset)[:3]
+        entries += bytes([len(encoded)])
+        texts += encoded
+        offset += len(encoded)
+    text_start = 4 + index_size + len(entries)
+    header = struct.pack(">L", text_start + index_size)
+    return header + b"\0" * index_size + entries + texts
+
+
+class TestIPIPIndex(unittest.TestCase):
+    records = [
+        ("0.255.255.255", "Reserved\tReserved"),
+        ("1.0.0.255", "Australia\tQueensland"),
+        ("1.0.1.255", "China\tFujian"),
+        ("1.2.3.4", "China\tBeijing"),
+        ("8.8.8.8", "United States\tCalifornia"),
+        ("255.255.255.255", "Reserved\tReserved"),
+    ]
+
+    def setUp(self):
+        self.db_file = tempfile.NamedTemporaryFile(suffix=".dat")
+        self.db_file.write(_build_dat(self.records))
+        self.db_file.flush()
+        self.db = IPIPIndex(self.db_file.name)
+
+    def tearDown(self):
+        self.db_file.close()
+
+    def test_lookup_matches_pyipip(self):
+        origin = pyipip.IPIPDatabase(self.db_file.name)
+        ips = [
+            "0.0.0.0",
+            "1.0.0.0",
+            "1.0.0.255",
+            "1.0.1.0",
+            "1.2.3.4",
+            "1.2.3.5",
+            "8.8.8.8",
+            "8.8.8.9",
+            "255.255.255.255",
+        ]
+        for ip in ips:
+            self.assertEqual(self.db.lookup(ip), origin.lookup(ip), ip)
+
+    def test_lookup_fields(self):
+        fujian = self.db.lookup_fields(ip_to_int("1.0.1.1"))
+        self.assertEqual(fujian, ("China", "Fujian"))
+        california = self.db.lookup_fields(ip_to_int("8.8.8.8"))
+        self.assertEqual(california, ("United States", "California"))
+
+    def test_ip_to_int(self):
+        self.assertEqual(ip_to_int("0.0.0.0"), 0)
+        self.assertEqual(ip_to_int("1.2.3.4"), 0x01020304)
+        self.assertEqual(ip_to_int("255.255.255.255"), 0xFFFFFFFF)